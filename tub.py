@@ -1,25 +1,41 @@
 import json
 import os
-import pandas as pd
 import hashlib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, date, timedelta
 import re
+import mimetypes
 import hmac
 from io import BytesIO
 from typing import Optional, List, Dict
-from flask import Flask, request, jsonify, send_from_directory, g
+from flask import Flask, Response, request, jsonify, send_from_directory, g, abort
+from werkzeug.utils import safe_join
 from flask_cors import CORS
 from PIL import Image
 import logging
 import sqlite3
 from googleapiclient.discovery import build
-import uuid
+import secrets
+import random
 import threading
 import subprocess
 import time
 import atexit
+import weakref
+import queue
+import itertools
+from collections import OrderedDict
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 from fpdf import FPDF
+from openpyxl import Workbook
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 # from auth import require_auth 
@@ -31,11 +47,89 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # === CONFIG ===
-with open("config.json", "r", encoding="utf-8") as f:
+CONFIG_PATH = "config.json"
+with open(CONFIG_PATH, "r", encoding="utf-8") as f:
     CONFIG = json.load(f)
 
+# Admin o'zgarishlari config.json ga darhol emas, ko'pi bilan soniyada bir marta yoziladi
+CONFIG_SAVE_INTERVAL = 1.0
+_config_dirty = threading.Event()
+_config_write_lock = threading.Lock()
+_config_writer = None
+_config_writer_lock = threading.Lock()
+
+def save_config():
+    """CONFIG ni config.json ga atomar yozish"""
+    with _config_write_lock:
+        _config_dirty.clear()
+        try:
+            data = json.dumps(CONFIG, ensure_ascii=False, indent=2)
+        except RuntimeError:
+            # CONFIG shu payt o'zgartirilmoqda - keyingi safar yoziladi
+            _config_dirty.set()
+            return
+        tmp_path = f"{CONFIG_PATH}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, CONFIG_PATH)
+
+def config_writer_loop():
+    """O'zgargan CONFIG ni fon rejimida saqlash"""
+    while True:
+        _config_dirty.wait()
+        time.sleep(CONFIG_SAVE_INTERVAL)
+        try:
+            save_config()
+        except Exception as e:
+            logger.error(f"Config saqlashda xato: {e}")
+
+def mark_config_dirty():
+    """CONFIG o'zgarganini belgilash (yozuvchi thread saqlaydi)"""
+    global _config_writer
+    with _config_writer_lock:
+        if _config_writer is None or not _config_writer.is_alive():
+            _config_writer = threading.Thread(
+                target=config_writer_loop, name="config-writer", daemon=True
+            )
+            _config_writer.start()
+    _config_dirty.set()
+
+def flush_config():
+    """Saqlanmagan CONFIG o'zgarishlarini yozish"""
+    if _config_dirty.is_set():
+        save_config()
+
+atexit.register(flush_config)
+
 users = {u["username"]: u for u in CONFIG.get("users", [])}
-MAINTENANCE_MODE = False
+
+# Foydalanuvchi bo'yicha oldindan hisoblangan qiymatlar (CONFIG ga yozilmaydi):
+# parol hashlari raw 32 bayt, ruxsat etilgan do'konlar frozenset
+password_hashes = {}
+assigned_store_sets = {}
+DUMMY_PASSWORD_HASH = bytes(32)
+
+def prepare_user(user):
+    """Foydalanuvchi uchun login/ruxsat tekshiruvi qiymatlarini tayyorlash"""
+    username = user["username"]
+    try:
+        password_hashes[username] = bytes.fromhex(user.get("password_hash", ""))
+    except ValueError:
+        password_hashes.pop(username, None)
+    assigned_store_sets[username] = frozenset(str(s) for s in user.get("assigned_stores", []))
+
+def get_assigned_stores(user) -> frozenset:
+    """Foydalanuvchiga biriktirilgan campaign ID lar"""
+    stores = assigned_store_sets.get(user["username"])
+    if stores is None:
+        prepare_user(user)
+        stores = assigned_store_sets[user["username"]]
+    return stores
+
+for _u in users.values():
+    prepare_user(_u)
+MAINTENANCE_MODE = threading.Event()
+_maintenance_lock = threading.Lock()
 # Papkalarni yaratish
 os.makedirs("temp", exist_ok=True)
 os.makedirs("data", exist_ok=True)
@@ -50,39 +144,123 @@ NGROK_AUTH_TOKEN = CONFIG.get("ngrok_auth_token", "")
 NGROK_ENABLED = CONFIG.get("ngrok_enabled", False)
 PUBLIC_URL = None
 
+# === YANDEX API SESSION ===
+# Bitta session - TCP/TLS ulanishlar qayta ishlatiladi
+# Umumiy headerlar session da, har so'rovda faqat Api-Key qo'shiladi
+YANDEX_BASE_HEADERS = MappingProxyType({
+    "Content-Type": "application/json",
+    "User-Agent": "NUB/1.0",
+    "Accept": "*/*"
+})
+YANDEX_SESSION = requests.Session()
+YANDEX_SESSION.headers.update(YANDEX_BASE_HEADERS)
+YANDEX_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=64,
+    pool_maxsize=64,
+    # read=0: sekin javob (read timeout) qayta so'ralmaydi - faqat ulanish xatolari va 502/503/504
+    max_retries=Retry(total=3, read=0, backoff_factor=0.3, status_forcelist=[502, 503, 504], raise_on_status=False)
+))
+YANDEX_TIMEOUT = (3.05, 27)  # (connect, read)
+YANDEX_MAX_WORKERS = 16  # parallel so'rovlar; pool_maxsize dan oshmasligi kerak
+
 
 # === DATABASE SETUP ===
+class ThreadConnection:
+    """Thread ga tegishli SQLite ulanishi - thread tugaganda yopiladi"""
+    def __init__(self, conn):
+        self.conn = conn
+    
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+    
+    def __del__(self):
+        self.close()
+
 class Database:
     def __init__(self, db_path='data/orders.db'):
         self.db_path = db_path
         self._local = threading.local()
+        self._connections = weakref.WeakSet()
         self.init_db()
     
     def get_conn(self):
-        if not hasattr(self._local, 'conn'):
-            self._local.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-            self._local.conn.row_factory = sqlite3.Row
-        return self._local.conn
+        holder = getattr(self._local, 'holder', None)
+        if holder is None or holder.conn is None:
+            conn = sqlite3.connect(
+                self.db_path,
+                check_same_thread=False,
+                timeout=5.0,
+                cached_statements=256
+            )
+            conn.row_factory = sqlite3.Row
+            # Har bir ulanish uchun sozlamalar (journal_mode=WAL init_db da bir marta)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA cache_size=-20000")
+            conn.execute("PRAGMA mmap_size=268435456")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute("PRAGMA cache_spill=OFF")
+            holder = ThreadConnection(conn)
+            self._local.holder = holder
+            self._connections.add(holder)
+        return holder.conn
     
     def get_cursor(self):
         return self.get_conn().cursor()
     
     def commit(self):
-        if hasattr(self._local, 'conn'):
-            self._local.conn.commit()
+        holder = getattr(self._local, 'holder', None)
+        if holder is not None and holder.conn is not None:
+            holder.conn.commit()
     
     def close(self):
-        if hasattr(self._local, 'conn'):
-            self._local.conn.close()
-            delattr(self._local, 'conn')
+        holder = getattr(self._local, 'holder', None)
+        if holder is not None:
+            holder.close()
+            delattr(self._local, 'holder')
+    
+    def close_all(self):
+        """Barcha thread ulanishlarini yopish (dastur tugaganda)"""
+        for holder in list(self._connections):
+            holder.close()
+    
+    def add_column_if_missing(self, cursor, table, column, definition):
+        """Eski bazalarga yangi ustun qo'shish"""
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column not in {row["name"] for row in cursor.fetchall()}:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            return True
+        return False
+    
+    def add_epoch_column(self, cursor, table, source_column):
+        """created_at_epoch ustunini eski bazalarga qo'shish va to'ldirish"""
+        # ALTER TABLE da strftime() default bo'lolmaydi - yangi qatorlarni trigger to'ldiradi
+        if not self.add_column_if_missing(cursor, table, "created_at_epoch", "INTEGER"):
+            return
+        cursor.execute(
+            f"UPDATE {table} SET created_at_epoch = CAST(strftime('%s', {source_column}) AS INTEGER)"
+        )
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_created_at_epoch
+            AFTER INSERT ON {table} WHEN NEW.created_at_epoch IS NULL
+            BEGIN
+                UPDATE {table} SET created_at_epoch = CAST(strftime('%s', 'now') AS INTEGER)
+                WHERE rowid = NEW.rowid;
+            END
+        ''')
     
     def init_db(self):
         conn = self.get_conn()
         cursor = conn.cursor()
-        
+
+        # WAL rejimi bazada saqlanadi - faqat ishga tushganda bir marta
+        cursor.execute("PRAGMA journal_mode=WAL")
+
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS sessions (
-                token_hash TEXT PRIMARY KEY,
+                token_hash BLOB PRIMARY KEY,
                 username TEXT NOT NULL,
                 expiry REAL NOT NULL,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
@@ -102,9 +280,13 @@ class Database:
                 username TEXT NOT NULL,
                 role TEXT NOT NULL,
                 main_save BOOLEAN DEFAULT FALSE,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                campaign_id TEXT,
+                created_at_epoch INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
             )
         ''')
+        # get_old_orders seller filtri uchun (eski bazalarda bu ustun yo'q edi)
+        self.add_column_if_missing(cursor, "decisions", "campaign_id", "TEXT")
         
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS reports (
@@ -132,6 +314,7 @@ class Database:
                 supplier_delivered_at DATETIME,
                 seller_accepted_at DATETIME,
                 created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                created_at_epoch INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
                 UNIQUE(order_id, campaign_id)
             )
         ''')
@@ -151,7 +334,8 @@ class Database:
                 status TEXT DEFAULT 'pending', -- 'pending', 'seller_accepted', 'supplier_accepted', 'completed'
                 alternative_product TEXT,
                 created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                created_at_epoch INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
             )
         ''')
         
@@ -173,31 +357,128 @@ class Database:
                 status TEXT NOT NULL,  -- 'accepted' or 'returned'
                 seller_username TEXT,
                 supplier_username TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                created_at_epoch INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
             )
         ''')
         
+        # Sana bo'yicha filtrlar uchun butun son (epoch) ustun
+        self.add_epoch_column(cursor, "decisions", "timestamp")
+        self.add_epoch_column(cursor, "return_status", "created_at")
+        self.add_epoch_column(cursor, "daily_orders", "created_at")
+        self.add_epoch_column(cursor, "accepted_returned", "timestamp")
+        
+        # Tez-tez ishlatiladigan WHERE/ORDER BY uchun indekslar
+        # (return_status(order_id, campaign_id) uchun UNIQUE indeks allaqachon bor)
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_return_status_cid_status
+            ON return_status(campaign_id, supplier_status, supplier_delivered_at DESC)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_daily_orders_cid_oid
+            ON daily_orders(campaign_id, order_id)
+        ''')
+        cursor.execute("DROP INDEX IF EXISTS idx_decisions_user_role_ts")
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_decisions_user_role_epoch
+            ON decisions(username, role, created_at_epoch DESC)
+        ''')
+        # supplier_get_orders filtri va canceled_orders JOIN i uchun
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_dec_filter ON decisions(role, main_save, decision)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_dec_order ON decisions(order_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_ar_campaign ON accepted_returned(campaign_id)")
+        # processed_orders.username PRIMARY KEY - alohida indeks kerak emas
+        
+        conn.commit()
+        # Planner yangi indekslarni to'g'ri tanlashi uchun statistika
+        cursor.execute("ANALYZE")
         conn.commit()
 
 db = Database()
+atexit.register(db.close_all)
 
 # === REQUEST CONTEXT HANDLING ===
 @app.before_request
 def before_request():
     g.db = db
-    g.cursor = db.get_cursor()
 
 @app.teardown_request
 def teardown_request(exception=None):
-    if hasattr(g, 'db'):
-        g.db.commit()
-        if exception:
-            g.db.get_conn().rollback()
+    # Yozuvchi endpointlar o'z tranzaksiyasini o'zi commit qiladi
+    if exception and hasattr(g, 'db'):
+        g.db.get_conn().rollback()
 
 # === UTILITY FUNCTIONS ===
+class TTLCache:
+    """Oddiy thread-safe kesh: LRU + yashash muddati (TTL)"""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            cache_until, value = entry
+            if now > cache_until:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+    
+    def set(self, key, value, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self._data[key] = (now + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
 def sha256_hex(s: str) -> str:
     return hashlib.sha256(s.encode("utf-8")).hexdigest()
 
+def get_bearer_token(auth_header: str) -> str:
+    """Authorization headeridan tokenni ajratish (faqat boshidagi 'Bearer ')"""
+    if auth_header.startswith("Bearer "):
+        return auth_header[7:].strip()
+    return auth_header.strip()
+
+def ojson(obj, status=200):
+    """Katta JSON javoblar uchun tez serializatsiya (orjson bo'lmasa jsonify)"""
+    if orjson is None:
+        resp = jsonify(obj)
+        resp.status_code = status
+        return resp
+    return Response(
+        orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_NAIVE_UTC),
+        status=status,
+        mimetype="application/json"
+    )
+
+def fetchall_dicts(cursor) -> List[Dict]:
+    """Natijani dict ro'yxati sifatida olish (ustun nomlari bir marta o'qiladi)"""
+    if cursor.description is None:
+        return []
+    cursor.row_factory = None
+    columns = [col[0] for col in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def hash_session_token(token: str) -> bytes:
+    """Session tokenining bazadagi kaliti (BLAKE2b-128, raw bytes)"""
+    return hashlib.blake2b(token.encode("utf-8"), digest_size=16).digest()
+
 def require_auth(roles=None):
     """Decorator: foydalanuvchi avtorizatsiyasini tekshirish"""
     def decorator(f):
@@ -206,8 +487,8 @@ def require_auth(roles=None):
             if not auth_header:
                 return jsonify({"detail": "Authorization token talab qilinadi"}), 401
             
-            token = auth_header.replace('Bearer ', '').strip()
-            user = get_user_from_token(token)
+            token = get_bearer_token(auth_header)
+            user = getattr(g, "_maint_user", None) or get_user_from_token(token)
             
             if not user:
                 return jsonify({"detail": "Yaroqsiz token yoki sessiya muddati tugagan"}), 401
@@ -239,14 +520,20 @@ def get_supplier_returned_orders():
     if orders is None:
         return jsonify({"detail": "Xato yuz berdi"}), 500
     
-    # Bazadagi statuslarni qo'shamiz
-    cursor = g.cursor
-    for order in orders:
+    # Bazadagi statuslarni qo'shamiz (bitta so'rov bilan)
+    status_map = {}
+    order_ids = [order["order_id"] for order in orders]
+    if order_ids:
+        placeholders = ','.join(['?'] * len(order_ids))
+        cursor = g.db.get_cursor()
         cursor.execute(
-            "SELECT supplier_status, seller_status FROM return_status WHERE order_id = ? AND campaign_id = ?",
-            (order["order_id"], campaign_id)
+            f"SELECT order_id, supplier_status, seller_status FROM return_status WHERE campaign_id = ? AND order_id IN ({placeholders})",
+            [campaign_id] + order_ids
         )
-        row = cursor.fetchone()
+        status_map = {row["order_id"]: row for row in cursor.fetchall()}
+    
+    for order in orders:
+        row = status_map.get(order["order_id"])
         if row:
             order["supplier_status"] = row["supplier_status"]
             order["seller_status"] = row["seller_status"]
@@ -254,7 +541,7 @@ def get_supplier_returned_orders():
             order["supplier_status"] = "pending"
             order["seller_status"] = "pending"
     
-    return jsonify(orders)
+    return ojson(orders)
 
 # === SUPPLIER ACCEPT RETURN ===
 @app.route("/api/supplier/accept_return", methods=["POST"])
@@ -269,16 +556,15 @@ def supplier_accept_return():
     if not order_id or not campaign_id:
         return jsonify({"detail": "Order ID va Campaign ID talab qilinadi"}), 400
     
-    cursor = g.cursor
+    cursor = g.db.get_cursor()
     
     # Statusni yangilash yoki yaratish
-    cursor.execute('''
-        INSERT OR REPLACE INTO return_status 
-        (order_id, campaign_id, supplier_status, supplier_username, supplier_accepted_at)
-        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-    ''', (order_id, campaign_id, "accepted", user["username"]))
-    
-    g.db.commit()
+    with g.db.get_conn():
+        cursor.execute('''
+            INSERT OR REPLACE INTO return_status 
+            (order_id, campaign_id, supplier_status, supplier_username, supplier_accepted_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (order_id, campaign_id, "accepted", user["username"]))
     
     logger.info(f"Supplier {user['username']} qaytarilgan buyurtmani qabul qildi: {order_id}")
     
@@ -300,26 +586,28 @@ def supplier_deliver_return():
     if not order_id or not campaign_id:
         return jsonify({"detail": "Order ID va Campaign ID talab qilinadi"}), 400
     
-    cursor = g.cursor
+    cursor = g.db.get_cursor()
     
     # Statusni yangilash
-    cursor.execute('''
-        UPDATE return_status 
-        SET supplier_status = 'delivered', supplier_delivered_at = CURRENT_TIMESTAMP
-        WHERE order_id = ? AND campaign_id = ? AND supplier_username = ?
-    ''', (order_id, campaign_id, user["username"]))
-    
-    if cursor.rowcount == 0:
-        return jsonify({"detail": "Buyurtma topilmadi yoki siz qabul qilmagansiz"}), 400
-    
-    # PDF generatsiya
-    try:
+    with g.db.get_conn():
+        cursor.execute('''
+            UPDATE return_status 
+            SET supplier_status = 'delivered', supplier_delivered_at = CURRENT_TIMESTAMP
+            WHERE order_id = ? AND campaign_id = ? AND supplier_username = ?
+        ''', (order_id, campaign_id, user["username"]))
+        
+        if cursor.rowcount == 0:
+            return jsonify({"detail": "Buyurtma topilmadi yoki siz qabul qilmagansiz"}), 400
+        
         cursor.execute(
             "SELECT product_name, sku, quantity FROM return_status WHERE order_id = ? AND campaign_id = ?",
             (order_id, campaign_id)
         )
         row = cursor.fetchone()
-        
+    
+    # PDF generatsiya (tranzaksiyadan tashqarida)
+    pdf_filename = None
+    try:
         if row:
             items = [{
                 "order_id": order_id,
@@ -328,21 +616,19 @@ def supplier_deliver_return():
                 "quantity": row["quantity"]
             }]
             
-            date_str = date.today().strftime("%Y-%m-%d")
+            date_str = time.strftime("%Y-%m-%d")
             pdf_filename = generate_return_pdf(items, "supplier", date_str, user["username"])
             
             logger.info(f"Supplier return PDF yaratildi: {pdf_filename}")
     except Exception as e:
         logger.error(f"PDF yaratishda xato: {e}")
     
-    g.db.commit()
-    
     logger.info(f"Supplier {user['username']} qaytarilgan buyurtmani topshirdi: {order_id}")
     
     return jsonify({
         "status": "success",
         "message": "Qaytarilgan buyurtma topshirildi",
-        "pdf_filename": pdf_filename if 'pdf_filename' in locals() else None
+        "pdf_filename": pdf_filename
     })
 
 # === SELLER RETURNED ORDERS ===
@@ -357,11 +643,11 @@ def get_seller_returned_orders():
         return jsonify({"detail": "Campaign ID talab qilinadi"}), 400
     
     # Faqat ruxsat etilgan campaign
-    assigned = {str(s) for s in user.get("assigned_stores", [])}
+    assigned = get_assigned_stores(user)
     if campaign_id not in assigned:
         return jsonify({"detail": "Ruxsat yo'q"}), 403
     
-    cursor = g.cursor
+    cursor = g.db.get_cursor()
     
     # Supplier tomonidan topshirilgan buyurtmalar
     cursor.execute('''
@@ -370,24 +656,27 @@ def get_seller_returned_orders():
         ORDER BY supplier_delivered_at DESC
     ''', (campaign_id,))
     
-    rows = cursor.fetchall()
+    rows = fetchall_dicts(cursor)
     
-    # Yandex ma'lumotlarini qo'shamiz
-    result = []
-    for row in rows:
-        order_data = dict(row)
-        
-        # Yandex API dan qo'shimcha ma'lumot olish
+    # Yandex API dan qo'shimcha ma'lumotlarni parallel olish
+    def fetch_extra(row):
         try:
-            yandex_order = fetch_single_order(campaign_id, order_data["order_id"], user)
-            if yandex_order:
-                order_data.update(yandex_order)
+            return fetch_single_order(campaign_id, row["order_id"], user)
         except:
-            pass
-        
+            return None
+    
+    yandex_orders = []
+    if rows:
+        with ThreadPoolExecutor(max_workers=min(16, len(rows))) as executor:
+            yandex_orders = list(executor.map(fetch_extra, rows))
+    
+    result = []
+    for order_data, yandex_order in zip(rows, yandex_orders):
+        if yandex_order:
+            order_data.update(yandex_order)
         result.append(order_data)
     
-    return jsonify(result)
+    return ojson(result)
 
 # === SELLER ACCEPT RETURN ===
 @app.route("/api/seller/accept_return", methods=["POST"])
@@ -402,26 +691,28 @@ def seller_accept_return():
     if not order_id or not campaign_id:
         return jsonify({"detail": "Order ID va Campaign ID talab qilinadi"}), 400
     
-    cursor = g.cursor
+    cursor = g.db.get_cursor()
     
     # Statusni yangilash
-    cursor.execute('''
-        UPDATE return_status 
-        SET seller_status = 'accepted', seller_username = ?, seller_accepted_at = CURRENT_TIMESTAMP
-        WHERE order_id = ? AND campaign_id = ? AND supplier_status = 'delivered'
-    ''', (user["username"], order_id, campaign_id))
-    
-    if cursor.rowcount == 0:
-        return jsonify({"detail": "Buyurtma topilmadi yoki hali topshirilmagan"}), 400
-    
-    # PDF generatsiya
-    try:
+    with g.db.get_conn():
+        cursor.execute('''
+            UPDATE return_status 
+            SET seller_status = 'accepted', seller_username = ?, seller_accepted_at = CURRENT_TIMESTAMP
+            WHERE order_id = ? AND campaign_id = ? AND supplier_status = 'delivered'
+        ''', (user["username"], order_id, campaign_id))
+        
+        if cursor.rowcount == 0:
+            return jsonify({"detail": "Buyurtma topilmadi yoki hali topshirilmagan"}), 400
+        
         cursor.execute(
             "SELECT product_name, sku, quantity FROM return_status WHERE order_id = ? AND campaign_id = ?",
             (order_id, campaign_id)
         )
         row = cursor.fetchone()
-        
+    
+    # PDF generatsiya (tranzaksiyadan tashqarida)
+    pdf_filename = None
+    try:
         if row:
             items = [{
                 "order_id": order_id,
@@ -430,21 +721,19 @@ def seller_accept_return():
                 "quantity": row["quantity"]
             }]
             
-            date_str = date.today().strftime("%Y-%m-%d")
+            date_str = time.strftime("%Y-%m-%d")
             pdf_filename = generate_return_pdf(items, "seller", date_str, user["username"])
             
             logger.info(f"Seller return PDF yaratildi: {pdf_filename}")
     except Exception as e:
         logger.error(f"PDF yaratishda xato: {e}")
     
-    g.db.commit()
-    
     logger.info(f"Seller {user['username']} qaytarilgan buyurtmani qabul qildi: {order_id}")
     
     return jsonify({
         "status": "success",
         "message": "Qaytarilgan buyurtma qabul qilindi",
-        "pdf_filename": pdf_filename if 'pdf_filename' in locals() else None
+        "pdf_filename": pdf_filename
     })
 
 # === DAILY ORDERS MANAGEMENT ===
@@ -456,7 +745,7 @@ def get_daily_orders(campaign_id):
     
     # Ruxsatni tekshirish
     if user.get("role") == "seller":
-        assigned = {str(s) for s in user.get("assigned_stores", [])}
+        assigned = get_assigned_stores(user)
         if str(campaign_id) not in assigned:
             return jsonify({"detail": "Ruxsat yo'q"}), 403
     
@@ -466,14 +755,23 @@ def get_daily_orders(campaign_id):
     if orders is None:
         return jsonify({"detail": "Xato yuz berdi"}), 500
     
-    # Bazadagi qarorlarni qo'shamiz
-    cursor = g.cursor
-    for order in orders:
+    # Navbatdagi qarorlar yozilishini kutamiz, keyin bazadan o'qiymiz (bitta so'rov bilan)
+    flush_daily_decisions()
+    decision_map = {}
+    order_ids = [order["order_id"] for order in orders]
+    if order_ids:
+        placeholders = ','.join(['?'] * len(order_ids))
+        cursor = g.db.get_cursor()
         cursor.execute(
-            "SELECT seller_decision, supplier_decision, status FROM daily_orders WHERE order_id = ? AND campaign_id = ?",
-            (order["order_id"], campaign_id)
+            f"SELECT order_id, seller_decision, supplier_decision, status FROM daily_orders WHERE campaign_id = ? AND order_id IN ({placeholders}) ORDER BY id",
+            [campaign_id] + order_ids
         )
-        row = cursor.fetchone()
+        # Bir buyurtmaga bir nechta qator bo'lishi mumkin - avvalgidek birinchisi olinadi
+        for row in cursor.fetchall():
+            decision_map.setdefault(row["order_id"], row)
+    
+    for order in orders:
+        row = decision_map.get(order["order_id"])
         if row:
             order["seller_decision"] = row["seller_decision"]
             order["supplier_decision"] = row["supplier_decision"]
@@ -483,7 +781,107 @@ def get_daily_orders(campaign_id):
             order["supplier_decision"] = None
             order["status"] = "pending"
     
-    return jsonify(orders)
+    return ojson(orders)
+
+# === DAILY DECISION WRITER ===
+# Tez-tez keladigan qarorlar navbatga qo'yiladi va bitta tranzaksiyada yoziladi
+SQL_DAILY_SELLER = '''
+    INSERT OR REPLACE INTO daily_orders 
+    (order_id, campaign_id, seller_decision, seller_username, status, updated_at)
+    VALUES (?, ?, ?, ?, 'seller_accepted', CURRENT_TIMESTAMP)
+'''
+
+SQL_DAILY_SUPPLIER = '''
+    INSERT OR REPLACE INTO daily_orders 
+    (order_id, campaign_id, supplier_decision, supplier_username, alternative_product, status, updated_at)
+    VALUES (?, ?, ?, ?, ?, 'supplier_accepted', CURRENT_TIMESTAMP)
+'''
+
+# Navbat elementi: (sql, params, urinishlar_soni); sql=None bo'lsa params - flush uchun threading.Event
+DECISION_QUEUE = queue.Queue()
+DECISION_BATCH_MAX = 200
+DECISION_MAX_ATTEMPTS = 5  # baza band bo'lsa (SQLITE_BUSY) qayta urinishlar
+DECISION_RETRY_DELAY = 0.5
+DECISION_FLUSH_TIMEOUT = 5
+_decision_writer = None
+_decision_writer_lock = threading.Lock()
+
+def write_daily_decisions(conn, items):
+    """Qarorlarni bitta tranzaksiyada yozish"""
+    with conn:
+        # Ketma-ket bir xil SQL larni executemany bilan (tartib saqlanadi)
+        for sql, group in itertools.groupby(items, key=lambda item: item[0]):
+            conn.executemany(sql, [item[1] for item in group])
+
+def decision_writer_loop():
+    """Navbatdagi qarorlarni to'plab bazaga yozish"""
+    while True:
+        items = [DECISION_QUEUE.get()]
+        while len(items) < DECISION_BATCH_MAX:
+            try:
+                items.append(DECISION_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+        
+        # Flush belgilari alohida - ular shu paket yozilgandan keyin belgilanadi
+        barriers = [item[1] for item in items if item[0] is None]
+        batch = [item for item in items if item[0] is not None]
+        
+        conn = db.get_conn()
+        requeued = False
+        try:
+            if batch:
+                write_daily_decisions(conn, batch)
+        except Exception as e:
+            # Bitta xato qator boshqa foydalanuvchilarning qarorlarini yo'qotmasin - birma-bir yozamiz
+            logger.warning(f"Kunlik qarorlar paketida xato, birma-bir yoziladi: {e}")
+            for sql, params, attempts in batch:
+                try:
+                    write_daily_decisions(conn, [(sql, params, attempts)])
+                except sqlite3.OperationalError as e:
+                    if attempts + 1 < DECISION_MAX_ATTEMPTS:
+                        DECISION_QUEUE.put((sql, params, attempts + 1))
+                        requeued = True
+                    else:
+                        logger.error(f"Kunlik qaror saqlanmadi {params}: {e}")
+                except Exception as e:
+                    logger.error(f"Kunlik qaror saqlanmadi {params}: {e}")
+        finally:
+            for event in barriers:
+                event.set()
+            for _ in items:
+                DECISION_QUEUE.task_done()
+        
+        if requeued:
+            time.sleep(DECISION_RETRY_DELAY)
+
+def ensure_decision_writer():
+    """Yozuvchi thread ni ishga tushirish (fork dan keyin ham)"""
+    global _decision_writer
+    with _decision_writer_lock:
+        if _decision_writer is None or not _decision_writer.is_alive():
+            _decision_writer = threading.Thread(
+                target=decision_writer_loop, name="decision-writer", daemon=True
+            )
+            _decision_writer.start()
+
+def flush_daily_decisions(timeout=DECISION_FLUSH_TIMEOUT):
+    """Shu paytgacha navbatga qo'yilgan qarorlar yozilishini kutish"""
+    if _decision_writer is None or not _decision_writer.is_alive():
+        return True
+    barrier = threading.Event()
+    DECISION_QUEUE.put((None, barrier, 0))
+    if not barrier.wait(timeout):
+        logger.warning("Kunlik qarorlarni kutish vaqti tugadi")
+        return False
+    return True
+
+def drain_daily_decisions():
+    """Chiqishda navbatni to'liq bo'shatish (qayta urinishlar bilan)"""
+    if _decision_writer is not None and _decision_writer.is_alive():
+        DECISION_QUEUE.join()
+
+atexit.register(drain_daily_decisions)
 
 # === SAVE DAILY DECISION ===
 @app.route("/api/save_daily_decision", methods=["POST"])
@@ -501,76 +899,82 @@ def save_daily_decision():
     if not order_id or not campaign_id or not decision:
         return jsonify({"detail": "Barcha maydonlar talab qilinadi"}), 400
     
-    cursor = g.cursor
+    # Javob yozishdan oldin qaytadi - noto'g'ri turdagi qiymat navbatga tushmasin
+    if not isinstance(order_id, (str, int)) or not isinstance(campaign_id, (str, int)) \
+            or not isinstance(decision, str) or not isinstance(alternative_product, str):
+        return jsonify({"detail": "Maydonlar noto'g'ri formatda"}), 400
+    order_id = str(order_id)
+    campaign_id = str(campaign_id)
     
     if user["role"] == "seller":
         # Seller qarori
-        cursor.execute('''
-            INSERT OR REPLACE INTO daily_orders 
-            (order_id, campaign_id, seller_decision, seller_username, status, updated_at)
-            VALUES (?, ?, ?, ?, 'seller_accepted', CURRENT_TIMESTAMP)
-        ''', (order_id, campaign_id, decision, user["username"]))
-        
+        item = (SQL_DAILY_SELLER, (order_id, campaign_id, decision, user["username"]), 0)
     elif user["role"] == "supplier":
         # Supplier qarori (seller 'no' deb belgilagan bo'lsa ham 'yes' qilishi mumkin)
-        cursor.execute('''
-            INSERT OR REPLACE INTO daily_orders 
-            (order_id, campaign_id, supplier_decision, supplier_username, alternative_product, status, updated_at)
-            VALUES (?, ?, ?, ?, ?, 'supplier_accepted', CURRENT_TIMESTAMP)
-        ''', (order_id, campaign_id, decision, user["username"], alternative_product))
+        item = (SQL_DAILY_SUPPLIER, (order_id, campaign_id, decision, user["username"], alternative_product), 0)
     
-    g.db.commit()
+    ensure_decision_writer()
+    DECISION_QUEUE.put(item)
     
     logger.info(f"{user['role']} {user['username']} kunlik buyurtma qarorini saqladi: {order_id}")
     
     return jsonify({
         "status": "success",
         "message": "Qaror saqlandi"
-    })
+    }), 202
 
 # === OLD ORDERS ===
+# SQL matni o'zgarmas - sqlite3 statement cache dan foydalanadi
+OLD_ORDERS_AGE = 30 * 86400  # 30 kun (sekund)
+
+SQL_OLD_SELLER = '''
+    SELECT * FROM decisions 
+    WHERE username = ? AND role = 'seller' 
+    AND created_at_epoch < ?
+    AND campaign_id IN (SELECT value FROM json_each(?))
+    ORDER BY created_at_epoch DESC
+    LIMIT 100
+'''
+
+SQL_OLD_SUPPLIER = '''
+    SELECT * FROM decisions 
+    WHERE username = ? AND role = 'supplier' 
+    AND created_at_epoch < ?
+    ORDER BY created_at_epoch DESC
+    LIMIT 100
+'''
+
+SQL_OLD_ADMIN = '''
+    SELECT * FROM decisions 
+    WHERE created_at_epoch < ?
+    ORDER BY created_at_epoch DESC
+    LIMIT 200
+'''
+
 @app.route("/api/old_orders", methods=["GET"])
 @require_auth()
 def get_old_orders():
     """Eski buyurtmalar (30 kundan oldingi)"""
     user = g.user
     
-    cursor = g.cursor
+    cursor = g.db.get_cursor()
+    cutoff = int(time.time()) - OLD_ORDERS_AGE
     
     if user["role"] == "seller":
         # Seller uchun faqat o'z campaignlari
-        assigned = user.get("assigned_stores", [])
-        placeholders = ','.join(['?'] * len(assigned))
+        assigned = list(get_assigned_stores(user))
+        if not assigned:
+            return jsonify([])
         
-        cursor.execute(f'''
-            SELECT * FROM decisions 
-            WHERE username = ? AND role = 'seller' 
-            AND date(timestamp) < date('now', '-30 days')
-            AND campaign_id IN ({placeholders})
-            ORDER BY timestamp DESC
-            LIMIT 100
-        ''', [user["username"]] + assigned)
+        cursor.execute(SQL_OLD_SELLER, (user["username"], cutoff, json.dumps(assigned)))
         
     elif user["role"] == "supplier":
-        cursor.execute('''
-            SELECT * FROM decisions 
-            WHERE username = ? AND role = 'supplier' 
-            AND date(timestamp) < date('now', '-30 days')
-            ORDER BY timestamp DESC
-            LIMIT 100
-        ''', (user["username"],))
+        cursor.execute(SQL_OLD_SUPPLIER, (user["username"], cutoff))
     
     elif user["role"] == "admin":
-        cursor.execute('''
-            SELECT * FROM decisions 
-            WHERE date(timestamp) < date('now', '-30 days')
-            ORDER BY timestamp DESC
-            LIMIT 200
-        ''')
-    
-    rows = cursor.fetchall()
+        cursor.execute(SQL_OLD_ADMIN, (cutoff,))
     
-    return jsonify([dict(row) for row in rows])
+    return ojson(fetchall_dicts(cursor))
 
 # === HELPER: Fetch single order ===
 def fetch_single_order(campaign_id, order_id, user):
@@ -579,16 +983,11 @@ def fetch_single_order(campaign_id, order_id, user):
     if not token:
         return None
     
-    headers = {
-        "Content-Type": "application/json",
-        "User-Agent": "NUB/1.0",
-        "Accept": "*/*",
-        "Api-Key": token
-    }
+    headers = {"Api-Key": token}
     
     try:
         url = f"https://api.partner.market.yandex.ru/v2/campaigns/{campaign_id}/orders/{order_id}"
-        resp = requests.get(url, headers=headers, timeout=30)
+        resp = YANDEX_SESSION.get(url, headers=headers, timeout=YANDEX_TIMEOUT)
         
         if resp.status_code != 200:
             return None
@@ -613,10 +1012,15 @@ def fetch_single_order(campaign_id, order_id, user):
 # === YANGI PDF GENERATOR ===
 def generate_return_pdf(items, role, date_str, username):
     """Qaytarilgan buyurtmalar uchun PDF yaratish"""
+    # Bir xil buyurtmalar uchun PDF allaqachon bo'lsa, qayta yaratmaymiz
+    order_ids = ','.join(sorted(str(item.get("order_id", "")) for item in items))
+    order_id_hash = hashlib.blake2b(order_ids.encode("utf-8"), digest_size=8).hexdigest()
+    filename = f"temp/return_{role}_{date_str}_{username}_{order_id_hash}.pdf"
+    if os.path.exists(filename):
+        return filename
+    
     pdf = PDF()
     pdf.add_page()
-    pdf.add_font("DejaVu", "", "fonts/DejaVuSans.ttf", uni=True)
-    pdf.add_font("DejaVu", "B", "fonts/DejaVuSans-Bold.ttf", uni=True)
     
     # Sarlavha
     pdf.set_font("DejaVu", "B", 16)
@@ -635,57 +1039,57 @@ def generate_return_pdf(items, role, date_str, username):
     headers = ["№", "Mahsulot nomi", "SKU", "Buyurtma ID", "Miqdor", "Holat"]
     widths = [10, 70, 30, 30, 20, 30]
     
-    pdf.set_font("DejaVu", "B", 10)
-    for i, header in enumerate(headers):
-        pdf.cell(widths[i], 10, header, 1, 0, 'C')
-    pdf.ln()
-    
     # Ma'lumotlar
-    pdf.set_font("DejaVu", "", 9)
-    for idx, item in enumerate(items, 1):
-        status = "Qaytarildi" if role == "supplier" else "Qabul qilindi"
-        row = [
+    status = "Qaytarildi" if role == "supplier" else "Qabul qilindi"
+    rows = [
+        (
             str(idx),
-            item.get("product_name", "")[:45],
-            item.get("sku", ""),
-            item.get("order_id", ""),
+            str(item.get("product_name", "")[:45]),
+            str(item.get("sku", "")),
+            str(item.get("order_id", "")),
             str(item.get("quantity", 0)),
             status
-        ]
-        
-        for i, value in enumerate(row):
-            pdf.cell(widths[i], 10, str(value), 1, 0, 'C' if i != 1 else 'L')
-        pdf.ln()
+        )
+        for idx, item in enumerate(items, 1)
+    ]
+    pdf.draw_table(headers, widths, rows)
     
     # Faylni saqlash
-    filename = f"temp/return_{role}_{date_str}_{username}.pdf"
-    pdf.output(filename)
+    pdf.save(filename)
     
     return filename
 @app.route("/api/admin/toggle_maintenance", methods=["POST"])
 @require_auth(["admin"])
 def toggle_maintenance():
     """Saytni to'xtatish/yoqish"""
-    global MAINTENANCE_MODE
-    MAINTENANCE_MODE = not MAINTENANCE_MODE
+    with _maintenance_lock:
+        if MAINTENANCE_MODE.is_set():
+            MAINTENANCE_MODE.clear()
+        else:
+            MAINTENANCE_MODE.set()
+        maintenance = MAINTENANCE_MODE.is_set()
     
-    logger.info(f"Maintenance mode {'activated' if MAINTENANCE_MODE else 'deactivated'} by {g.user['username']}")
+    logger.info(f"Maintenance mode {'activated' if maintenance else 'deactivated'} by {g.user['username']}")
     
     return jsonify({
         "status": "success",
-        "maintenance_mode": MAINTENANCE_MODE,
-        "message": f"Sayt {'to\'xtatildi' if MAINTENANCE_MODE else 'yoqildi'}"
+        "maintenance_mode": maintenance,
+        "message": f"Sayt {'to\'xtatildi' if maintenance else 'yoqildi'}"
     })
 @app.before_request
 def check_maintenance():
     """Barcha requestlarni tekshirish"""
-    if MAINTENANCE_MODE and request.path.startswith('/api/') and not request.path.endswith('/public_url'):
+    if not MAINTENANCE_MODE.is_set():
+        return None
+    if request.path.startswith('/api/') and not request.path.endswith('/public_url'):
         # Faqat adminlar maintenance mode da ishlashi mumkin
         auth_header = request.headers.get("Authorization")
         if auth_header:
-            token = auth_header.replace('Bearer ', '').strip()
+            token = get_bearer_token(auth_header)
             user = get_user_from_token(token)
             if user and user.get("role") == "admin":
+                # require_auth qayta tekshirmasligi uchun
+                g._maint_user = user
                 return None
         
         return jsonify({
@@ -699,13 +1103,10 @@ def get_today_orders(campaign_id):
     user = g.user
     
     if user.get("role") == "seller":
-        assigned = {str(s) for s in user.get("assigned_stores", [])}
+        assigned = get_assigned_stores(user)
         if str(campaign_id) not in assigned:
             return jsonify({"detail": "Ruxsat yo'q"}), 403
     
-    # Bugungi sanani olish
-    today = datetime.now().strftime("%Y-%m-%d")
-    
     # Yandex API dan buyurtmalarni olish
     orders = fetch_yandex_orders(campaign_id, "PROCESSING", user)
     if orders is None:
@@ -713,7 +1114,34 @@ def get_today_orders(campaign_id):
     
     # Real loyihada buyurtmalarni sanasi bo'yicha filtrlash kerak
     # Hozircha barchasini qaytaramiz
-    return jsonify(orders)
+    return ojson(orders)
+
+
+# === SESSION CACHE ===
+# token_hash (bytes) -> (expiry, user); sessions SELECT ni har requestda qilmaslik uchun
+SESSION_CACHE_TTL = 60
+SESSION_CACHE_MAXSIZE = 4096
+SESSION_PURGE_PROBABILITY = 0.01  # login da eski sessiyalarni tozalash ehtimoli
+_session_cache = TTLCache(SESSION_CACHE_MAXSIZE, SESSION_CACHE_TTL)
+
+def session_cache_get(hashed: bytes, now: float):
+    """Keshdan foydalanuvchini olish (muddati o'tgan bo'lsa None)"""
+    entry = _session_cache.get(hashed, now)
+    if entry is None:
+        return None
+    expiry, user = entry
+    if now > expiry:
+        _session_cache.pop(hashed)
+        return None
+    return user
+
+def session_cache_put(hashed: bytes, expiry: float, user: dict, now: float):
+    """Sessiyani keshga yozish"""
+    _session_cache.set(hashed, (expiry, user), now)
+
+def session_cache_invalidate(hashed: bytes):
+    """Sessiyani keshdan o'chirish"""
+    _session_cache.pop(hashed)
 
 
 def get_user_from_token(token: str):
@@ -721,8 +1149,14 @@ def get_user_from_token(token: str):
     if not token:
         return None
     
-    hashed = sha256_hex(token)
-    cursor = g.cursor
+    hashed = hash_session_token(token)
+    now = time.time()
+    
+    user = session_cache_get(hashed, now)
+    if user:
+        return user
+    
+    cursor = g.db.get_cursor()
     
     cursor.execute(
         "SELECT username, expiry FROM sessions WHERE token_hash = ?",
@@ -736,13 +1170,17 @@ def get_user_from_token(token: str):
     username, expiry = row
     
     # Session muddatini tekshirish
-    if datetime.now().timestamp() > expiry:
-        cursor.execute("DELETE FROM sessions WHERE token_hash = ?", (hashed,))
-        g.db.commit()
+    if now > expiry:
+        with g.db.get_conn():
+            cursor.execute("DELETE FROM sessions WHERE token_hash = ?", (hashed,))
+        session_cache_invalidate(hashed)
         logger.info(f"Session expired for user: {username}")
         return None
     
-    return users.get(username)
+    user = users.get(username)
+    if user:
+        session_cache_put(hashed, expiry, user, now)
+    return user
 
 
 # === NGROK MANAGEMENT ===
@@ -800,14 +1238,71 @@ def get_public_url():
     })
 
 # === IMAGE DOWNLOAD ===
+CLEAN_QUERY_RE = re.compile(r"[^a-zA-Zа-яА-Я0-9\s]")
+SAFE_NAME_RE = re.compile(r"[^A-Za-z0-9]")
+IMAGE_MAX_WORKERS = 8
+# Doimiy threadlar: har biri o'z CSE klienti (_cse_local) va keep-alive ulanishlarini saqlaydi
+IMAGE_EXECUTOR = ThreadPoolExecutor(max_workers=IMAGE_MAX_WORKERS, thread_name_prefix="image")
+# Rasmi topilmagan so'rovlar: CSE kvotasini qayta-qayta sarflamaslik uchun
+IMAGE_MISS_CACHE = TTLCache(maxsize=2048, ttl=600)
+
+# Rasm saytlari uchun alohida session (keep-alive), Yandex pooli bilan aralashmasin
+IMAGE_SESSION = requests.Session()
+IMAGE_SESSION.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=IMAGE_MAX_WORKERS))
+IMAGE_SESSION.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=IMAGE_MAX_WORKERS))
+
+# Rasm keshi: blake2b(query) -> fayl yo'li (server qayta ishga tushganda ham saqlanadi)
+IMAGE_CACHE_PATH = "data/image_cache.json"
+_image_cache_lock = threading.Lock()
+try:
+    with open(IMAGE_CACHE_PATH, "r", encoding="utf-8") as f:
+        IMAGE_CACHE = json.load(f)
+except (OSError, ValueError):
+    IMAGE_CACHE = {}
+
+# httplib2 thread-safe emas, shuning uchun CSE service har bir thread uchun bir marta yaratiladi
+_cse_local = threading.local()
+
+def get_cse_service(api_key: str):
+    """Google CSE service obyektini olish (qayta build qilmasdan)"""
+    if getattr(_cse_local, "api_key", None) != api_key:
+        _cse_local.service = build(
+            "customsearch", "v1",
+            developerKey=api_key,
+            cache_discovery=False
+        )
+        _cse_local.api_key = api_key
+    return _cse_local.service
+
+def save_image_cache(query_hash: str, path: str):
+    """Rasm keshiga yozish (atomar)"""
+    with _image_cache_lock:
+        IMAGE_CACHE[query_hash] = path
+        tmp_path = f"{IMAGE_CACHE_PATH}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(IMAGE_CACHE, f, ensure_ascii=False)
+        os.replace(tmp_path, IMAGE_CACHE_PATH)
+
+def normalize_image_query(query: str) -> str:
+    """Kesh kaliti uchun so'rovni normallashtirish (registr va bo'shliqlar)"""
+    return " ".join(query.lower().split())
+
 def download_image(query: str) -> Optional[str]:
     """Google CSE orqali rasmlarni yuklash"""
     try:
-        clean_query = re.sub(r"[^a-zA-Zа-яА-Я0-9\s]", "", query)[:60]
-        safe_name = re.sub(r"[^A-Za-z0-9]", "_", clean_query)[:40]
-        path = f"temp/{safe_name}.jpg"
+        query_hash = hashlib.blake2b(normalize_image_query(query).encode("utf-8"), digest_size=8).hexdigest()
+        cached_path = IMAGE_CACHE.get(query_hash)
+        if cached_path and os.path.exists(cached_path):
+            return cached_path
+        if IMAGE_MISS_CACHE.get(query_hash):
+            return None
+        
+        clean_query = CLEAN_QUERY_RE.sub("", query)[:60]
+        safe_name = SAFE_NAME_RE.sub("_", clean_query)[:40]
+        path = f"temp/{safe_name}_{query_hash}.jpg"
         
         if os.path.exists(path):
+            save_image_cache(query_hash, path)
             return path
         
         cse_config = CONFIG.get("google_cse", {})
@@ -818,11 +1313,7 @@ def download_image(query: str) -> Optional[str]:
             logger.warning("Google CSE konfiguratsiyasi topilmadi")
             return None
         
-        service = build(
-            "customsearch", "v1",
-            developerKey=api_key,
-            cache_discovery=False
-        )
+        service = get_cse_service(api_key)
         
         search_term = f"{query} -site:tiktok.com filetype:jpg OR filetype:png"
         res = service.cse().list(
@@ -834,6 +1325,7 @@ def download_image(query: str) -> Optional[str]:
         ).execute()
         
         if 'items' not in res:
+            IMAGE_MISS_CACHE.set(query_hash, True)
             return None
         
         image_urls = [item['link'] for item in res['items'][:3]]
@@ -844,13 +1336,18 @@ def download_image(query: str) -> Optional[str]:
             filtered = image_urls
         
         if not filtered:
+            IMAGE_MISS_CACHE.set(query_hash, True)
             return None
         
-        img_resp = requests.get(filtered[0], timeout=15)
+        img_resp = IMAGE_SESSION.get(filtered[0], timeout=15)
         img_resp.raise_for_status()
         
-        img = Image.open(BytesIO(img_resp.content)).convert("RGB")
+        img = Image.open(BytesIO(img_resp.content))
+        # Katta JPEG larni dekoder o'zi kichraytirib o'qiydi
+        img.draft("RGB", (800, 800))
+        img = img.convert("RGB")
         img.save(path, "JPEG", quality=85)
+        save_image_cache(query_hash, path)
         return path
         
     except Exception as e:
@@ -868,27 +1365,34 @@ def login():
     if not username or not password:
         return jsonify({"detail": "Login va parol talab qilinadi"}), 400
     
+    provided_hash = hashlib.sha256(password.encode("utf-8")).digest()
+    
     user = users.get(username)
     if not user:
+        # Vaqt bo'yicha farq bo'lmasligi uchun baribir solishtiramiz
+        hmac.compare_digest(provided_hash, DUMMY_PASSWORD_HASH)
         return jsonify({"detail": "Foydalanuvchi topilmadi"}), 401
     
-    provided_hash = sha256_hex(password)
-    stored_hash = user.get("password_hash", "")
+    stored_hash = password_hashes.get(username, DUMMY_PASSWORD_HASH)
     
     if not hmac.compare_digest(provided_hash, stored_hash):
         return jsonify({"detail": "Noto'g'ri parol"}), 401
     
     # Session yaratish
-    session_token = str(uuid.uuid4())
-    hashed_session = sha256_hex(session_token)
-    expiry = datetime.now().timestamp() + (3600 * 8)
+    session_token = secrets.token_urlsafe(32)
+    hashed_session = hash_session_token(session_token)
+    now = time.time()
+    expiry = now + (3600 * 8)
     print(user.get("assigned_stores", []))
-    cursor = g.cursor
-    cursor.execute(
-        "INSERT OR REPLACE INTO sessions (token_hash, username, expiry) VALUES (?, ?, ?)",
-        (hashed_session, username, expiry)
-    )
-    g.db.commit()
+    cursor = g.db.get_cursor()
+    with g.db.get_conn():
+        cursor.execute(
+            "INSERT OR REPLACE INTO sessions (token_hash, username, expiry) VALUES (?, ?, ?)",
+            (hashed_session, username, expiry)
+        )
+        # Muddati o'tgan sessiyalarni vaqti-vaqti bilan tozalash (jadval kichik qoladi)
+        if random.random() < SESSION_PURGE_PROBABILITY:
+            cursor.execute("DELETE FROM sessions WHERE expiry < ?", (now,))
     
     logger.info(f"User logged in: {username}")
     
@@ -906,16 +1410,84 @@ def login():
 def logout():
     """Logout endpoint"""
     auth_header = request.headers.get("Authorization")
-    token = auth_header.replace('Bearer ', '').strip()
-    hashed = sha256_hex(token)
+    token = get_bearer_token(auth_header)
+    hashed = hash_session_token(token)
     
-    cursor = g.cursor
-    cursor.execute("DELETE FROM sessions WHERE token_hash = ?", (hashed,))
-    g.db.commit()
+    cursor = g.db.get_cursor()
+    with g.db.get_conn():
+        cursor.execute("DELETE FROM sessions WHERE token_hash = ?", (hashed,))
+    session_cache_invalidate(hashed)
     
     return jsonify({"status": "logged out"})
 
 # === CAMPAIGNS ===
+# token -> Yandex campaigns ro'yxati; stats endpointlari har safar sahifalab chiqmasligi uchun
+CAMPAIGNS_CACHE = TTLCache(maxsize=256, ttl=120)
+
+def list_campaigns(token, no_cache=False):
+    """Token bo'yicha barcha campaignlarni olish (xom ro'yxat, keshlangan)"""
+    campaigns = None if no_cache else CAMPAIGNS_CACHE.get(token)
+    if campaigns is not None:
+        return campaigns
+    
+    headers = {"Api-Key": token}
+    
+    def fetch_page(page):
+        url = "https://api.partner.market.yandex.ru/v2/campaigns"
+        params = {"page": page, "pageSize": 50}
+        
+        resp = YANDEX_SESSION.get(url, headers=headers, params=params, timeout=YANDEX_TIMEOUT)
+        if resp.status_code != 200:
+            logger.error(f"Yandex API xatosi: {resp.status_code}")
+            return None
+        return resp.json()
+    
+    campaigns = []
+    complete = True
+    
+    # 1-sahifadan pagesCount ni bilib, qolganlarini parallel olamiz
+    data = fetch_page(1)
+    if data is None:
+        complete = False
+    elif data.get("campaigns"):
+        campaigns.extend(data["campaigns"])
+        
+        pages_count = data.get("pager", {}).get("pagesCount", 1)
+        if pages_count > 1:
+            with ThreadPoolExecutor(max_workers=min(YANDEX_MAX_WORKERS, pages_count - 1)) as executor:
+                for page_data in executor.map(fetch_page, range(2, pages_count + 1)):
+                    if page_data:
+                        campaigns.extend(page_data.get("campaigns", []))
+                    else:
+                        complete = False
+    
+    # Chala ro'yxatni keshlamaymiz
+    if complete:
+        CAMPAIGNS_CACHE.set(token, campaigns)
+    return campaigns
+
+def visible_campaigns(user, campaigns):
+    """Foydalanuvchi roliga qarab ruxsat etilgan campaignlar (xom)"""
+    role = user.get("role")
+    if role == "seller":
+        assigned = get_assigned_stores(user)
+        return [c for c in campaigns if str(c["id"]) in assigned]
+    if role in ("admin", "supplier"):
+        # Supplier va admin barcha kampaniyalarni ko'radi
+        return campaigns
+    return []
+
+def filter_campaigns(user, campaigns):
+    """Campaignlarni foydalanuvchi roliga qarab filtrlash (frontend formatida)"""
+    return [
+        {"id": str(c["id"]), "name": c.get("domain", f"Do'kon {c['id']}")}
+        for c in visible_campaigns(user, campaigns)
+    ]
+
+def visible_campaign_ids(user, token):
+    """Foydalanuvchi statistikasini ko'ra oladigan campaign ID lar"""
+    return [str(c["id"]) for c in visible_campaigns(user, list_campaigns(token))]
+
 @app.route("/api/campaigns", methods=["GET"])
 @require_auth()
 def get_campaigns():
@@ -926,62 +1498,8 @@ def get_campaigns():
     if not token:
         return jsonify({"detail": "Token topilmadi"}), 400
     
-    headers = {
-        "Content-Type": "application/json",
-        "User-Agent": "NUB/1.0",
-        "Accept": "*/*",
-        "Api-Key": token
-    }
-    
-    all_campaigns = []
-    page = 1
-    
     try:
-        while True:
-            url = "https://api.partner.market.yandex.ru/v2/campaigns"
-            params = {"page": page, "pageSize": 50}
-            
-            resp = requests.get(url, headers=headers, params=params, timeout=30)
-            if resp.status_code != 200:
-                logger.error(f"Yandex API xatosi: {resp.status_code}")
-                break
-            
-            data = resp.json()
-            campaigns = data.get("campaigns", [])
-            if not campaigns:
-                break
-            
-            all_campaigns.extend(campaigns)
-            
-            pager = data.get("pager", {})
-            if page >= pager.get("pagesCount", 1):
-                break
-            page += 1
-        
-        # Rolga qarab filtrlash
-        if user.get("role") == "seller":
-            assigned = {str(s) for s in user.get("assigned_stores", [])}
-            result = [
-                {"id": str(c["id"]), "name": c.get("domain", f"Do'kon {c['id']}")}
-                for c in all_campaigns
-                if str(c["id"]) in assigned
-            ]
-        elif user.get("role") == "admin":
-            result = [
-                {"id": str(c["id"]), "name": c.get("domain", f"Do'kon {c['id']}")}
-                for c in all_campaigns
-            ]
-        elif user.get("role") == "supplier":
-            # Supplier uchun barcha kampaniyalarni ko'rsatamiz
-            result = [
-                {"id": str(c["id"]), "name": c.get("domain", f"Do'kon {c['id']}")}
-                for c in all_campaigns
-            ]
-        else:
-            result = []
-        
-        return jsonify(result)
-        
+        return jsonify(filter_campaigns(user, list_campaigns(token)))
     except Exception as e:
         logger.error(f"Campaigns olishda xato: {e}")
         return jsonify({"detail": f"Xato: {str(e)}"}), 500
@@ -998,13 +1516,13 @@ def update_backend_url():
     
     # Config faylini yangilash
     CONFIG["backend_url"] = new_url
-    with open("config.json", "w", encoding="utf-8") as f:
-        json.dump(CONFIG, f, ensure_ascii=False, indent=2)
+    CAMPAIGNS_CACHE.clear()
+    mark_config_dirty()
     
     # Barcha sessiyalarga yangi URL ni saqlash (agar kerak bo'lsa)
-    cursor = g.cursor
-    cursor.execute("UPDATE sessions SET metadata = ?", (json.dumps({"backend_url": new_url}),))
-    g.db.commit()
+    cursor = g.db.get_cursor()
+    with g.db.get_conn():
+        cursor.execute("UPDATE sessions SET metadata = ?", (json.dumps({"backend_url": new_url}),))
     
     logger.info(f"Backend URL yangilandi: {new_url}")
     
@@ -1015,33 +1533,46 @@ def update_backend_url():
     })
 
 # === YANDEX API HELPER ===
-def fetch_yandex_orders(campaign_id, status="PROCESSING", user=None):
-    """Yandex API dan buyurtmalarni olish"""
+# (campaign_id, status, token) -> buyurtmalar; dashboard polling Yandex ga har safar bormasligi uchun
+YANDEX_ORDERS_CACHE = TTLCache(maxsize=256, ttl=30)
+
+def fetch_yandex_orders(campaign_id, status="PROCESSING", user=None, no_cache=False):
+    """Yandex API dan buyurtmalarni olish (qisqa muddatli kesh bilan)"""
     if not user:
         user = g.user
     
     token = user.get("token") or CONFIG.get("token")
     if not token:
         return None
+    
+    key = (str(campaign_id), status, token)
+    orders = None if no_cache else YANDEX_ORDERS_CACHE.get(key)
+    if orders is None:
+        orders = load_yandex_orders(campaign_id, status, token)
+        if orders is None:
+            return None
+        YANDEX_ORDERS_CACHE.set(key, orders)
+    
+    # Endpointlar natijani o'zgartiradi - keshdagi nusxaga tegmasin
+    return [dict(order) for order in orders]
+
+def load_yandex_orders(campaign_id, status, token):
+    """Yandex API dan buyurtmalarni yuklash (keshsiz)"""
     print(campaign_id)
-    headers = {
-        "Content-Type": "application/json",
-        "User-Agent": "NUB/1.0",
-        "Accept": "*/*",
-        "Api-Key": token
-    }
+    headers = {"Api-Key": token}
     
     try:
         url = f"https://api.partner.market.yandex.ru/v2/campaigns/{campaign_id}/orders"
         params = {"status": status}
         
-        resp = requests.get(url, headers=headers, params=params, timeout=30)
+        resp = YANDEX_SESSION.get(url, headers=headers, params=params, timeout=YANDEX_TIMEOUT)
         if resp.status_code != 200:
             logger.error(f"Yandex orders API xatosi: {resp.text}")
             return None
         
         orders_data = resp.json().get("orders", [])
         result = []
+        queries = []
         
         for order in orders_data:
             warehouse = order.get("delivery", {}).get("outlet", {}).get("name") or "Noma'lum"
@@ -1057,11 +1588,18 @@ def fetch_yandex_orders(campaign_id, status="PROCESSING", user=None):
                     "price": item.get("price", 0) * item.get("count", 1)
                 }
                 
-                img_path = download_image(f"{product_data['product_name']} {product_data['sku']}")
+                queries.append(f"{product_data['product_name']} {product_data['sku']}")
+                result.append(product_data)
+        
+        # Rasmlarni parallel yuklash (bir xil so'rov bir marta)
+        if queries:
+            unique_queries = list(dict.fromkeys(queries))
+            img_paths = dict(zip(unique_queries, IMAGE_EXECUTOR.map(download_image, unique_queries)))
+            
+            for product_data, query in zip(result, queries):
+                img_path = img_paths[query]
                 if img_path:
                     product_data["image"] = f"/temp/{os.path.basename(img_path)}"
-                
-                result.append(product_data)
         
         return result
         
@@ -1078,7 +1616,7 @@ def get_orders(campaign_id):
     
     # Campaign ID ni tekshirish
     if user.get("role") == "seller":
-        assigned = {str(s) for s in user.get("assigned_stores", [])}
+        assigned = get_assigned_stores(user)
         if str(campaign_id) not in assigned:
             return jsonify({"detail": "Bu campaign ga ruxsatingiz yo'q"}), 403
     
@@ -1086,7 +1624,7 @@ def get_orders(campaign_id):
     if orders is None:
         return jsonify({"detail": "Buyurtmalarni olishda xato"}), 500
     
-    return jsonify(orders)
+    return ojson(orders)
 
 @app.route("/api/canceled_orders/<campaign_id>", methods=["GET"])
 @require_auth()
@@ -1095,19 +1633,18 @@ def get_canceled_orders(campaign_id):
     user = g.user
     
     if user.get("role") == "seller":
-        assigned = {str(s) for s in user.get("assigned_stores", [])}
+        assigned = get_assigned_stores(user)
         if str(campaign_id) not in assigned:
             return jsonify({"detail": "Ruxsat yo'q"}), 403
         
         # Seller uchun faqat o'z campaign_id si bo'yicha qaytarilgan buyurtmalar
-        cursor = g.cursor
+        cursor = g.db.get_cursor()
         cursor.execute('''
             SELECT d.* FROM decisions d 
             JOIN accepted_returned ar ON d.order_id = ar.order_id 
             WHERE ar.campaign_id = ? AND d.role = 'supplier' AND d.decision = 'yes'
         ''', (campaign_id,))
-        rows = cursor.fetchall()
-        orders = [dict(row) for row in rows]
+        orders = fetchall_dicts(cursor)
     else:
         # Supplier/admin uchun Yandexdan bekor qilinganlar
         orders = fetch_yandex_orders(campaign_id, "CANCELLED", user)
@@ -1115,9 +1652,28 @@ def get_canceled_orders(campaign_id):
     if orders is None:
         return jsonify({"detail": "Xato yuz berdi"}), 500
     
-    return jsonify(orders)
+    return ojson(orders)
 
 # === STATISTICS ===
+def fetch_campaign_stats(campaign_id, headers, params):
+    """Bitta campaign statistikasini olish (groups ro'yxati yoki xatoda None)"""
+    try:
+        url = f"https://api.partner.market.yandex.ru/v2/campaigns/{campaign_id}/stats/orders.json"
+        resp = YANDEX_SESSION.get(url, headers=headers, params=params, timeout=YANDEX_TIMEOUT)
+        if resp.status_code != 200:
+            return None
+        return resp.json().get("groups", [])
+    except Exception as e:
+        logger.error(f"Campaign {campaign_id} statistikasida xato: {e}")
+        return None
+
+def fetch_all_campaign_stats(campaign_ids, headers, params):
+    """Barcha campaignlar statistikasini parallel olish (tartib saqlanadi)"""
+    if not campaign_ids:
+        return []
+    with ThreadPoolExecutor(max_workers=min(YANDEX_MAX_WORKERS, len(campaign_ids))) as executor:
+        return list(executor.map(lambda cid: fetch_campaign_stats(cid, headers, params), campaign_ids))
+
 @app.route("/api/order_stats", methods=["GET"])
 @require_auth()
 def get_order_stats():
@@ -1128,23 +1684,14 @@ def get_order_stats():
     if not token:
         return jsonify({"detail": "Token topilmadi"}), 400
     
-    headers = {
-        "Content-Type": "application/json",
-        "User-Agent": "NUB/1.0",
-        "Accept": "*/*",
-        "Api-Key": token
-    }
-    
-    # Campaigns ro'yxatini olish
-    campaigns_response = get_campaigns()
-    if isinstance(campaigns_response, tuple):
-        return campaigns_response
-    
-    campaigns_data = campaigns_response.get_json()
-    if not isinstance(campaigns_data, list):
-        return jsonify({"detail": "Campaigns ma'lumotlari noto'g'ri"}), 500
+    headers = {"Api-Key": token}
     
-    campaign_ids = [c["id"] for c in campaigns_data]
+    # Faqat ruxsat etilgan campaignlar (keshdan)
+    try:
+        campaign_ids = visible_campaign_ids(user, token)
+    except Exception as e:
+        logger.error(f"Campaigns olishda xato: {e}")
+        return jsonify({"detail": f"Xato: {str(e)}"}), 500
     
     stats = {
         "assembly": 0,
@@ -1154,33 +1701,24 @@ def get_order_stats():
         "canceled": 0
     }
     
-    for campaign_id in campaign_ids:
-        try:
-            url = f"https://api.partner.market.yandex.ru/v2/campaigns/{campaign_id}/stats/orders.json"
-            params = {"groupBy": "STATUS"}
-            
-            resp = requests.get(url, headers=headers, params=params, timeout=30)
-            if resp.status_code != 200:
-                continue
-            
-            groups = resp.json().get("groups", [])
-            for group in groups:
-                status = group.get("status")
-                count = group.get("ordersCount", 0)
-                
-                if status == "PROCESSING":
-                    stats["assembly"] += count
-                    stats["shipments"] += count
-                elif status == "DELIVERY":
-                    stats["delivery"] += count
-                elif status == "DELIVERED":
-                    stats["delivered"] += count
-                elif status == "CANCELLED":
-                    stats["canceled"] += count
-                    
-        except Exception as e:
-            logger.error(f"Campaign {campaign_id} statistikasida xato: {e}")
+    params = {"groupBy": "STATUS"}
+    for groups in fetch_all_campaign_stats(campaign_ids, headers, params):
+        if not groups:
             continue
+        
+        for group in groups:
+            status = group.get("status")
+            count = group.get("ordersCount", 0)
+            
+            if status == "PROCESSING":
+                stats["assembly"] += count
+                stats["shipments"] += count
+            elif status == "DELIVERY":
+                stats["delivery"] += count
+            elif status == "DELIVERED":
+                stats["delivered"] += count
+            elif status == "CANCELLED":
+                stats["canceled"] += count
     
     return jsonify(stats)
 
@@ -1210,42 +1748,29 @@ def get_sales_chart_data():
     else:
         return jsonify({"detail": "Noto'g'ri filter"}), 400
     
-    headers = {
-        "Content-Type": "application/json",
-        "User-Agent": "NUB/1.0",
-        "Accept": "*/*",
-        "Api-Key": token
-    }
-    
-    # Campaigns ro'yxatini olish
-    campaigns_response = get_campaigns()
-    if isinstance(campaigns_response, tuple):
-        return campaigns_response
-    
-    campaigns_data = campaigns_response.get_json()
-    if not isinstance(campaigns_data, list):
-        return jsonify({"detail": "Campaigns ma'lumotlari noto'g'ri"}), 500
+    headers = {"Api-Key": token}
     
-    campaign_ids = [c["id"] for c in campaigns_data]
+    # Faqat ruxsat etilgan campaignlar (keshdan)
+    try:
+        campaign_ids = visible_campaign_ids(user, token)
+    except Exception as e:
+        logger.error(f"Campaigns olishda xato: {e}")
+        return jsonify({"detail": f"Xato: {str(e)}"}), 500
     
     # Kundalik sotuvlar
     daily_sums = [0] * days
     labels = [(from_date + timedelta(d)).strftime("%Y-%m-%d") for d in range(days)]
     
-    for campaign_id in campaign_ids:
+    params = {
+        "fromDate": from_date.strftime("%Y-%m-%d"),
+        "toDate": today.strftime("%Y-%m-%d"),
+        "groupBy": "DAY"
+    }
+    for groups in fetch_all_campaign_stats(campaign_ids, headers, params):
+        if not groups:
+            continue
+        
         try:
-            url = f"https://api.partner.market.yandex.ru/v2/campaigns/{campaign_id}/stats/orders.json"
-            params = {
-                "fromDate": from_date.strftime("%Y-%m-%d"),
-                "toDate": today.strftime("%Y-%m-%d"),
-                "groupBy": "DAY"
-            }
-            
-            resp = requests.get(url, headers=headers, params=params, timeout=30)
-            if resp.status_code != 200:
-                continue
-            
-            groups = resp.json().get("groups", [])
             for group in groups:
                 day_str = group.get("date")
                 if not day_str:
@@ -1256,13 +1781,13 @@ def get_sales_chart_data():
                     day_index = (day_date - from_date).days
                     
                     if 0 <= day_index < days:
-                        for order in group.get("orders", []):
-                            if order.get("status") == "DELIVERED":
-                                order_sum = sum(
-                                    item.get("price", 0) * item.get("count", 1) 
-                                    for item in order.get("items", [])
-                                )
-                                daily_sums[day_index] += order_sum
+                        # Kunning barcha DELIVERED mahsulotlari bitta o'tishda yig'iladi
+                        daily_sums[day_index] += sum([
+                            item.get("price", 0) * item.get("count", 1)
+                            for order in group.get("orders", [])
+                            if order.get("status") == "DELIVERED"
+                            for item in order.get("items", [])
+                        ])
                 except ValueError:
                     continue
                     
@@ -1277,23 +1802,27 @@ def get_sales_chart_data():
 @require_auth(["admin"])
 def admin_get_users():
     """Barcha foydalanuvchilar ro'yxati"""
-    cursor = g.cursor
-    cursor.execute("SELECT count FROM processed_orders WHERE username = ?", (g.user["username"],))
-    processed_row = cursor.fetchone()
-    processed_count = processed_row[0] if processed_row else 0
-    
-    users_list = []
-    for u in CONFIG.get("users", []):
-        cursor.execute("SELECT count FROM processed_orders WHERE username = ?", (u["username"],))
-        row = cursor.fetchone()
-        
-        users_list.append({
+    config_users = CONFIG.get("users", [])
+    names = [u["username"] for u in config_users]
+    
+    # Barcha hisoblarni bitta so'rovda olish
+    counts = {}
+    if names:
+        cursor = g.db.get_cursor()
+        placeholders = ",".join("?" * len(names))
+        cursor.execute(f"SELECT username, count FROM processed_orders WHERE username IN ({placeholders})", names)
+        counts = {row[0]: row[1] for row in cursor.fetchall()}
+    
+    users_list = [
+        {
             "username": u["username"],
             "role": u.get("role", "seller"),
             "assigned_stores": u.get("assigned_stores", []),
             "token": u.get("token", ""),
-            "processed_orders": row[0] if row else 0
-        })
+            "processed_orders": counts.get(u["username"], 0)
+        }
+        for u in config_users
+    ]
     
     return jsonify(users_list)
 
@@ -1326,10 +1855,10 @@ def admin_create_user():
     }
     
     users[username] = new_user
+    prepare_user(new_user)
     CONFIG["users"].append(new_user)
     
-    with open("config.json", "w", encoding="utf-8") as f:
-        json.dump(CONFIG, f, ensure_ascii=False, indent=2)
+    mark_config_dirty()
     
     return jsonify({"status": "created"})
 
@@ -1363,14 +1892,16 @@ def admin_update_user():
         else:
             user["assigned_stores"] = []
     
+    prepare_user(user)
+    CAMPAIGNS_CACHE.clear()
+    
     # Config faylini yangilash
     for i, u in enumerate(CONFIG["users"]):
         if u["username"] == username:
             CONFIG["users"][i] = user
             break
     
-    with open("config.json", "w", encoding="utf-8") as f:
-        json.dump(CONFIG, f, ensure_ascii=False, indent=2)
+    mark_config_dirty()
     
     return jsonify({"status": "updated"})
 
@@ -1380,45 +1911,84 @@ def admin_update_user():
 def admin_update_styles():
     data = request.json
     CONFIG["styles"] = data.get("styles", {})
-    with open("config.json", "w", encoding="utf-8") as f:
-        json.dump(CONFIG, f, ensure_ascii=False, indent=2)
+    mark_config_dirty()
     return jsonify({"status": "styles updated"})
 
 # Yangi: Admin accepted/returned
 @app.route("/api/admin/accepted_returned/<campaign_id>", methods=["GET"])
 @require_auth(["admin"])
 def admin_accepted_returned(campaign_id):
-    cursor = g.cursor
+    cursor = g.db.get_cursor()
     cursor.execute("SELECT * FROM accepted_returned WHERE campaign_id = ?", (campaign_id,))
-    rows = cursor.fetchall()
-    return jsonify([dict(row) for row in rows])
+    return ojson(fetchall_dicts(cursor))
 
 # === SUPPLIER ORDERS ===
 @app.route("/api/supplier/orders", methods=["GET"])
 @require_auth(["supplier"])
 def supplier_get_orders():
     """Supplier uchun buyurtmalar"""
-    cursor = g.cursor
-    cursor.execute(
-        "SELECT * FROM decisions WHERE role = 'seller' AND main_save = 0 AND decision = 'yes'"
-    )
-    rows = cursor.fetchall()
+    cursor = g.db.get_cursor()
+    cursor.execute('''
+        SELECT id, order_id, decision, warehouse, product_name, quantity, sku, barcode, username
+        FROM decisions WHERE role = 'seller' AND main_save = 0 AND decision = 'yes'
+    ''')
+    result = fetchall_dicts(cursor)
     
-    result = []
-    for row in rows:
-        result.append({
-            "id": row[0],
-            "order_id": row[1],
-            "decision": row[2],
-            "warehouse": row[3],
-            "product_name": row[4],
-            "quantity": row[5],
-            "sku": row[6],
-            "barcode": row[7],
-            "username": row[8]
-        })
-    
-    return jsonify(result)
+    return ojson(result)
+
+# === PDF QUEUE ===
+# Hisobot PDF lari fon rejimida yaratiladi, holati /api/pdf_status/<task_id> orqali
+PDF_QUEUE = queue.Queue()
+PDF_TASKS = TTLCache(maxsize=4096, ttl=3600)  # task_id -> {"status", "filename"}
+_pdf_worker = None
+_pdf_worker_lock = threading.Lock()
+
+def pdf_worker_loop():
+    """Navbatdagi PDF vazifalarini bajarish"""
+    while True:
+        task_id, func, args = PDF_QUEUE.get()
+        try:
+            filename = func(*args)
+            PDF_TASKS.set(task_id, {"status": "ready", "filename": os.path.basename(filename)})
+        except Exception as e:
+            logger.error(f"PDF yaratishda xato: {e}")
+            PDF_TASKS.set(task_id, {"status": "error", "filename": None})
+        finally:
+            PDF_QUEUE.task_done()
+
+def ensure_pdf_worker():
+    """PDF thread ni ishga tushirish (fork dan keyin ham)"""
+    global _pdf_worker
+    with _pdf_worker_lock:
+        if _pdf_worker is None or not _pdf_worker.is_alive():
+            _pdf_worker = threading.Thread(
+                target=pdf_worker_loop, name="pdf-worker", daemon=True
+            )
+            _pdf_worker.start()
+
+def flush_pdf_queue():
+    """Navbatdagi PDF lar yaratilishini kutish"""
+    if _pdf_worker is not None and _pdf_worker.is_alive():
+        PDF_QUEUE.join()
+
+atexit.register(flush_pdf_queue)
+
+def enqueue_pdf(func, *args) -> str:
+    """PDF vazifasini navbatga qo'yish, task_id qaytaradi"""
+    ensure_pdf_worker()
+    task_id = secrets.token_hex(16)
+    PDF_TASKS.set(task_id, {"status": "pending", "filename": None})
+    PDF_QUEUE.put((task_id, func, args))
+    return task_id
+
+@app.route("/api/pdf_status/<task_id>", methods=["GET"])
+@require_auth()
+def pdf_status(task_id):
+    """PDF vazifasi holati: pending / ready / error"""
+    task = PDF_TASKS.get(task_id)
+    if task is None:
+        return jsonify({"detail": "Vazifa topilmadi"}), 404
+    return jsonify({"task_id": task_id, **task})
 
 # === SAVE DECISIONS ===
 @app.route("/api/save", methods=["POST"])
@@ -1437,15 +2007,12 @@ def save_decisions():
     if not decisions:
         return jsonify({"detail": "Hech qanday qaror berilmagan"}), 400
     
-    cursor = g.cursor
+    main_save = 0 if temp_save else 1
+    seller_username = user["username"] if user["role"] == "seller" else ""
+    supplier_username = user["username"] if user["role"] == "supplier" else ""
     
-    # Ma'lumotlarni bazaga saqlash
-    for d in decisions:
-        cursor.execute('''
-            INSERT INTO decisions 
-            (order_id, decision, warehouse, product_name, quantity, sku, barcode, username, role, main_save)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
+    decisions_rows = [
+        (
             d.get("order_id"),
             d.get("decision"),
             d.get("warehouse", ""),
@@ -1455,57 +2022,84 @@ def save_decisions():
             d.get("barcode", ""),
             user["username"],
             user["role"],
-            0 if temp_save else 1
-        ))
-        
-        # Accepted/returned saqlash
-        status = 'accepted' if d.get("decision") == "yes" else 'returned'
-        cursor.execute('''
-            INSERT INTO accepted_returned 
-            (campaign_id, order_id, product_name, quantity, status, seller_username, supplier_username)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (
+            main_save,
+            str(d.get("campaign_id", ""))
+        )
+        for d in decisions
+    ]
+    
+    # Accepted/returned saqlash
+    ar_rows = [
+        (
             d.get("campaign_id", ""),
             d.get("order_id"),
             d.get("product_name", ""),
             d.get("quantity", 1),
-            status,
-            user["username"] if user["role"] == "seller" else "",
-            user["username"] if user["role"] == "supplier" else ""
-        ))
+            'accepted' if d.get("decision") == "yes" else 'returned',
+            seller_username,
+            supplier_username
+        )
+        for d in decisions
+    ]
     
-    # Processed orders hisobini yangilash
-    cursor.execute(
-        "INSERT OR REPLACE INTO processed_orders (username, count) VALUES (?, COALESCE((SELECT count FROM processed_orders WHERE username = ?), 0) + ?)",
-        (user["username"], user["username"], len(decisions))
-    )
+    # Ma'lumotlarni bazaga bitta tranzaksiyada saqlash
+    cursor = g.db.get_cursor()
+    with g.db.get_conn():
+        cursor.executemany('''
+            INSERT INTO decisions 
+            (order_id, decision, warehouse, product_name, quantity, sku, barcode, username, role, main_save, campaign_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', decisions_rows)
+        
+        cursor.executemany('''
+            INSERT INTO accepted_returned 
+            (campaign_id, order_id, product_name, quantity, status, seller_username, supplier_username)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', ar_rows)
+        
+        # Processed orders hisobini yangilash
+        cursor.execute('''
+            INSERT INTO processed_orders (username, count) VALUES (?, ?)
+            ON CONFLICT(username) DO UPDATE SET count = COALESCE(count, 0) + excluded.count
+        ''', (user["username"], len(decisions)))
     
-    g.db.commit()
+    # PDF yaratish (agar temp_save bo'lmasa): (funksiya, argumentlar)
+    pdf_jobs = []
+    if not temp_save:
+        date_str = time.strftime("%Y-%m-%d")
+        username = user["username"]
+        
+        # "Yes" qarorlari uchun PDF
+        yes_decisions = [d for d in decisions if d.get("decision") == "yes"]
+        if yes_decisions:
+            pdf_jobs.append((generate_pdf, (yes_decisions, True, date_str, username)))
+        
+        # "No" qarorlari uchun PDF
+        no_decisions = [d for d in decisions if d.get("decision") == "no"]
+        if no_decisions:
+            pdf_jobs.append((generate_pdf, (no_decisions, False, date_str, username)))
+        
+        # Qaytarilgan uchun alohida PDF
+        if no_decisions and user["role"] == "supplier":
+            pdf_jobs.append((generate_returned_pdf, (no_decisions, date_str, username)))
     
-    # PDF yaratish (agar temp_save bo'lmasa)
     pdf_filenames = []
-    if not temp_save:
+    if pdf_jobs and request.args.get("sync") != "1":
+        # Fon rejimida; fayl nomi tayyor bo'lganda pdf_status orqali qaytariladi
+        # (shu kungi oldingi PDF bilan bir xil nom - oldindan berilsa eski fayl yuklanadi)
+        task_ids = [enqueue_pdf(func, *args) for func, args in pdf_jobs]
+        
+        return jsonify({
+            "status": "pending",
+            "pdf_filename": "",
+            "files": [],
+            "task_ids": task_ids
+        }), 202
+    
+    # ?sync=1 - PDF lar shu so'rovning o'zida yaratiladi
+    for func, args in pdf_jobs:
         try:
-            date_str = date.today().strftime("%Y-%m-%d")
-            
-            # "Yes" qarorlari uchun PDF
-            yes_decisions = [d for d in decisions if d.get("decision") == "yes"]
-            if yes_decisions:
-                pdf_yes = generate_pdf(yes_decisions, True, date_str, user["username"])
-                pdf_filenames.append(os.path.basename(pdf_yes))
-            
-            # "No" qarorlari uchun PDF
-            no_decisions = [d for d in decisions if d.get("decision") == "no"]
-            if no_decisions:
-                pdf_no = generate_pdf(no_decisions, False, date_str, user["username"])
-                pdf_filenames.append(os.path.basename(pdf_no))
-                
-            # Qaytarilgan uchun alohida PDF
-            returned_decisions = [d for d in decisions if d.get("decision") == "no" and user["role"] == "supplier"]
-            if returned_decisions:
-                pdf_returned = generate_returned_pdf(returned_decisions, date_str, user["username"])
-                pdf_filenames.append(os.path.basename(pdf_returned))
-                
+            pdf_filenames.append(os.path.basename(func(*args)))
         except Exception as e:
             logger.error(f"PDF yaratishda xato: {e}")
     
@@ -1516,31 +2110,83 @@ def save_decisions():
     })
 
 # === PDF GENERATION ===
+# Logolar server ishga tushganda bir marta tekshiriladi
+FINEOK_LOGO_EXISTS = os.path.exists("fineok_logo.jpg")
+SPPHONE_LOGO_EXISTS = os.path.exists("spphone_logo.png")
+
 class PDF(FPDF):
     """PDF yaratish klassi"""
+    # Birinchi hujjatda o'qilgan DejaVu shriftlari: (fonts, font_files)
+    _font_cache = None
+    _font_cache_lock = threading.Lock()
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.load_fonts()
+    
+    def load_fonts(self):
+        """DejaVu shriftlarini ulash (TTF faqat bir marta o'qiladi)"""
+        with PDF._font_cache_lock:
+            if PDF._font_cache is None:
+                self.add_font("DejaVu", "", "fonts/DejaVuSans.ttf", uni=True)
+                self.add_font("DejaVu", "B", "fonts/DejaVuSans-Bold.ttf", uni=True)
+                PDF._font_cache = (
+                    {k: dict(v, subset=list(v["subset"])) for k, v in self.fonts.items()},
+                    {k: dict(v) for k, v in self.font_files.items()}
+                )
+                return
+        
+        # subset va 'n' har bir hujjatda o'zgaradi - shuning uchun nusxa olinadi
+        fonts, font_files = PDF._font_cache
+        for key, font in fonts.items():
+            self.fonts[key] = dict(font, i=len(self.fonts) + 1, subset=list(font["subset"]))
+        for key, font_file in font_files.items():
+            self.font_files[key] = dict(font_file)
+    
+    def save(self, filename):
+        """PDF ni atomar saqlash (yozilayotgan fayl yuklab olinmasin)"""
+        tmp_path = f"{filename}.{threading.get_ident()}.tmp"
+        try:
+            self.output(tmp_path, "F")
+            os.replace(tmp_path, filename)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    
+    def draw_table(self, headers, widths, rows, row_height=10):
+        """Jadval: qalin sarlavha va qatorlar (2-ustun chapga, qolganlari markazga)"""
+        aligns = ['L' if i == 1 else 'C' for i in range(len(widths))]
+        
+        self.set_font("DejaVu", "B", 10)
+        for header, width in zip(headers, widths):
+            self.cell(width, row_height, header, 1, 0, 'C')
+        self.ln()
+        
+        self.set_font("DejaVu", "", 9)
+        for row in rows:
+            for value, width, align in zip(row, widths, aligns):
+                self.cell(width, row_height, value, 1, 0, align)
+            self.ln()
+    
     def header(self):
         # Logolarni qo'shish
         try:
-            if os.path.exists("fineok_logo.jpg"):
+            if FINEOK_LOGO_EXISTS:
                 self.image("fineok_logo.jpg", 10, 10, 40, 20)
         except:
             pass
         
         try:
-            if os.path.exists("spphone_logo.png"):
+            if SPPHONE_LOGO_EXISTS:
                 self.image("spphone_logo.png", self.w - 50, 10, 40, 20)
         except:
             pass
-        self.add_font("DejaVu", "", "fonts/DejaVuSans.ttf", uni=True)
-        self.add_font("DejaVu", "B", "fonts/DejaVuSans-Bold.ttf", uni=True)
         self.set_font("DejaVu", "B", 12)
         self.ln(25)
         self.cell(0, 10, f"НАКЛАДНАЯ № ____        ОТ {date.today().strftime('%d.%m.%Y')}", align="C")
         self.ln(5)
     
     def footer(self):
-        self.add_font("DejaVu", "", "fonts/DejaVuSans.ttf", uni=True)
-        self.add_font("DejaVu", "B", "fonts/DejaVuSans-Bold.ttf", uni=True) 
         self.set_y(-35)
         self.set_font("DejaVu", "", 9)
         self.cell(90, 6, "От FineOk: ________________________________", 0, 0, "L")
@@ -1550,12 +2196,18 @@ class PDF(FPDF):
         self.cell(10)
         self.cell(90, 6, "(Ф.И.О., подпись)", 0, 1, "L")
 
+def report_pdf_path(is_positive, date_str, username):
+    """generate_pdf yaratadigan fayl yo'li"""
+    return f"temp/{'positive' if is_positive else 'negative'}_report_{date_str}_{username}.pdf"
+
+def returned_pdf_path(date_str, username):
+    """generate_returned_pdf yaratadigan fayl yo'li"""
+    return f"temp/returned_report_{date_str}_{username}.pdf"
+
 def generate_pdf(items, is_positive, date_str, username):
     """PDF fayl yaratish"""
     pdf = PDF()
     pdf.add_page()
-    pdf.add_font("DejaVu", "", "fonts/DejaVuSans.ttf", uni=True)
-    pdf.add_font("DejaVu", "B", "fonts/DejaVuSans-Bold.ttf", uni=True)
     
     # Agar "No" qarorlari bo'lsa, ogohlantirish qo'shish
     if not is_positive:
@@ -1578,32 +2230,25 @@ def generate_pdf(items, is_positive, date_str, username):
     headers = ["№", "Наименование товара", "SKU", "Номер заказа", "Штрихкод", "Кол-во", "Статус"]
     widths = [10, 70, 25, 25, 25, 15, 20]
     
-    # Jadval sarlavhasi
-    pdf.set_font("DejaVu", "B", 10)
-    for i, header in enumerate(headers):
-        pdf.cell(widths[i], 10, header, 1, 0, 'C')
-    pdf.ln()
-    
     # Ma'lumotlar
-    pdf.set_font("DejaVu", "", 9)
-    for idx, item in enumerate(items, 1):
-        row = [
+    status = "OK" if is_positive else "NO"
+    rows = [
+        (
             str(idx),
-            item.get("product_name", "")[:50],
-            item.get("sku", ""),
-            item.get("order_id", ""),
-            item.get("barcode", ""),
+            str(item.get("product_name", "")[:50]),
+            str(item.get("sku", "")),
+            str(item.get("order_id", "")),
+            str(item.get("barcode", "")),
             str(item.get("quantity", 0)),
-            "OK" if is_positive else "NO"
-        ]
-        
-        for i, value in enumerate(row):
-            pdf.cell(widths[i], 10, str(value), 1, 0, 'C' if i != 1 else 'L')
-        pdf.ln()
+            status
+        )
+        for idx, item in enumerate(items, 1)
+    ]
+    pdf.draw_table(headers, widths, rows)
     
     # Faylni saqlash
-    filename = f"temp/{'positive' if is_positive else 'negative'}_report_{date_str}_{username}.pdf"
-    pdf.output(filename)
+    filename = report_pdf_path(is_positive, date_str, username)
+    pdf.save(filename)
     
     return filename
 
@@ -1620,65 +2265,98 @@ def generate_returned_pdf(items, date_str, username):
     headers = ["№", "Товар", "SKU", "Заказ", "Штрихкод", "Кол-во"]
     widths = [10, 70, 25, 25, 25, 15]
     
-    pdf.set_font("Arial", "B", 10)
-    for i, header in enumerate(headers):
-        pdf.cell(widths[i], 10, header, 1, 0, 'C')
-    pdf.ln()
-    
-    pdf.set_font("DejaVu", "", 9)
-    for idx, item in enumerate(items, 1):
-        row = [
+    rows = [
+        (
             str(idx),
-            item.get("product_name", "")[:50],
-            item.get("sku", ""),
-            item.get("order_id", ""),
-            item.get("barcode", ""),
+            str(item.get("product_name", "")[:50]),
+            str(item.get("sku", "")),
+            str(item.get("order_id", "")),
+            str(item.get("barcode", "")),
             str(item.get("quantity", 0))
-        ]
-        
-        for i, value in enumerate(row):
-            pdf.cell(widths[i], 10, str(value), 1, 0, 'C' if i != 1 else 'L')
-        pdf.ln()
+        )
+        for idx, item in enumerate(items, 1)
+    ]
+    pdf.draw_table(headers, widths, rows)
     
-    filename = f"temp/returned_report_{date_str}_{username}.pdf"
-    pdf.output(filename)
+    filename = returned_pdf_path(date_str, username)
+    pdf.save(filename)
     
     return filename
 
+# === FILE SENDING ===
+# nginx orqasida fayllarni nginx o'zi (sendfile) yuboradi, Flask faqat header qaytaradi.
+# nginx konfiguratsiyasi:
+#   proxy_set_header X-Forwarded-By nginx;
+#   location /_protected/temp/ { internal; alias /app/temp/; sendfile on; }
+#   location /_protected/data/ { internal; alias /app/data/; sendfile on; }
+ACCEL_LOCATIONS = {"temp": "/_protected/temp/", "data": "/_protected/data/"}
+
+def send_file_accel(directory, filename, as_attachment=False):
+    """Faylni X-Accel-Redirect orqali yoki (nginx bo'lmasa) send_from_directory bilan yuborish"""
+    location = ACCEL_LOCATIONS.get(directory)
+    if location is None or request.headers.get("X-Forwarded-By") != "nginx":
+        return send_from_directory(directory, filename, as_attachment=as_attachment)
+    
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    
+    response = Response(mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+    response.headers["X-Accel-Redirect"] = location + requests.utils.quote(filename)
+    if as_attachment:
+        response.headers.set("Content-Disposition", "attachment", filename=os.path.basename(filename))
+    return response
+
 # === PDF DOWNLOAD ===
 @app.route("/api/pdf/<filename>", methods=["GET"])
 # @require_auth()
 def get_pdf(filename):
     """PDF faylini yuklash"""
     try:
-        return send_from_directory("temp", filename, as_attachment=True)
+        return send_file_accel("temp", filename, as_attachment=True)
     except:
         return jsonify({"detail": "Fayl topilmadi"}), 404
 
 # === EXCEL REPORT ===
+EXCEL_PATH = "data/excel_report.xlsx"
+# Oxirgi yaratilgan fayl qaysi holatga mos: (MAX(rowid), COUNT(*))
+_EXCEL_CACHE = {"state": None}
+_excel_lock = threading.Lock()
+
 @app.route("/api/excel", methods=["GET"])
 @require_auth(["admin"])
 def get_excel_report():
-    """Excel hisobotini yuklash"""
-    cursor = g.cursor
-    cursor.execute("SELECT * FROM reports")
-    rows = cursor.fetchall()
+    """Excel hisobotini yuklash (reports o'zgarmagan bo'lsa qayta yaratilmaydi)"""
+    cursor = g.db.get_cursor()
+    cursor.execute("SELECT MAX(rowid), COUNT(*) FROM reports")
+    state = tuple(cursor.fetchone())
     
-    if not rows:
+    if not state[1]:
         return jsonify({"detail": "Hisobot hali yaratilmagan"}), 404
     
-    # DataFrame yaratish
-    df = pd.DataFrame(rows, columns=['id', 'date', 'username', 'accepted', 'rejected'])
-    excel_path = "data/excel_report.xlsx"
-    df.to_excel(excel_path, index=False)
+    with _excel_lock:
+        if _EXCEL_CACHE["state"] != state or not os.path.exists(EXCEL_PATH):
+            cursor.execute("SELECT id, date, username, accepted, rejected FROM reports")
+            
+            # write_only rejimda qatorlar xotirada to'planmaydi
+            wb = Workbook(write_only=True)
+            ws = wb.create_sheet()
+            ws.append(['id', 'date', 'username', 'accepted', 'rejected'])
+            for row in cursor:
+                ws.append(tuple(row))
+            
+            tmp_path = f"{EXCEL_PATH}.tmp"
+            wb.save(tmp_path)
+            os.replace(tmp_path, EXCEL_PATH)
+            _EXCEL_CACHE["state"] = state
     
-    return send_from_directory("data", "excel_report.xlsx", as_attachment=True)
+    return send_file_accel("data", "excel_report.xlsx", as_attachment=True)
 
 # === STATIC FILES ===
 @app.route('/temp/<path:filename>')
 def serve_temp(filename):
     """Temp fayllarni serv qilish"""
-    return send_from_directory('temp', filename)
+    return send_file_accel('temp', filename)
 
 @app.route('/')
 def serve_index():
@@ -1686,32 +2364,92 @@ def serve_index():
     return send_from_directory('.', 'dashboard.html')
 
 # === CLEANUP ===
+TEMP_MAX_AGE = 259200  # 3 kun
+TEMP_CLEANUP_INTERVAL = 3600  # har soatda
+
 def cleanup_temp():
     """Eski temp fayllarni o'chirish"""
+    cutoff = time.time() - TEMP_MAX_AGE
     try:
-        for file in os.listdir("temp"):
-            file_path = os.path.join("temp", file)
-            if os.path.isfile(file_path):
-                file_age = datetime.now().timestamp() - os.path.getctime(file_path)
-                if file_age > 259200:  # 3 kun
-                    os.remove(file_path)
+        # scandir: is_file/stat natijalari DirEntry da keshlanadi
+        with os.scandir("temp") as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False) and entry.stat().st_ctime < cutoff:
+                    os.remove(entry.path)
     except Exception as e:
         logger.error(f"Temp tozalashda xato: {e}")
 
+def schedule_cleanup_temp():
+    """cleanup_temp ni har soatda fon rejimida ishga tushirish"""
+    cleanup_temp()
+    timer = threading.Timer(TEMP_CLEANUP_INTERVAL, schedule_cleanup_temp)
+    timer.daemon = True
+    timer.start()
+
+# === SERVER ===
+# Bitta worker: sessiya keshi, maintenance holati va CONFIG jarayon ichida saqlanadi,
+# shuning uchun parallellik worker ichidagi threadlar hisobiga
+GUNICORN_OPTIONS = {
+    "bind": "0.0.0.0:8080",
+    "workers": 1,
+    "worker_class": "gthread",
+    "threads": 32,
+    "timeout": 120,
+    "preload_app": True
+}
+
+def register_master_exit(func):
+    """atexit hook ni faqat shu jarayonda bajarish (gunicorn workerlari fork orqali uni meros qiladi)"""
+    master_pid = os.getpid()
+    
+    def hook():
+        if os.getpid() == master_pid:
+            func()
+    
+    atexit.register(hook)
+
+def run_server():
+    """Serverni gunicorn (gthread) bilan, u bo'lmasa Flask dev server bilan ishga tushirish"""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        logger.warning("gunicorn o'rnatilmagan, Flask dev server ishlatiladi")
+        app.run(
+            host="0.0.0.0",
+            port=8080,
+            debug=False,
+            threaded=True,
+            use_reloader=False
+        )
+        return
+    
+    class GunicornApp(BaseApplication):
+        def load_config(self):
+            for key, value in GUNICORN_OPTIONS.items():
+                self.cfg.set(key, value)
+        
+        def load(self):
+            return app
+    
+    # Fork dan oldin ochilgan SQLite ulanishlari workerga o'tmasin
+    db.close_all()
+    GunicornApp().run()
+
 # === MAIN ===
 if __name__ == "__main__":
     print("=" * 70)
     print("GadgetPro Dashboard Backend - Ngrok versiyasi")
     print("=" * 70)
     
-    # Temp papkasini tozalash
-    cleanup_temp()
+    # Temp papkasini tozalash (keyin har soatda)
+    schedule_cleanup_temp()
     
     # Ngrok ni ishga tushirish
     public_url = start_ngrok()
     
-    # Exit handler - ngrok ni to'xtatish
-    atexit.register(stop_ngrok)
+    # Exit handler - ngrok ni to'xtatish (worker qayta ishga tushganda emas)
+    register_master_exit(stop_ngrok)
+    register_master_exit(YANDEX_SESSION.close)
     
     if public_url:
         print(f"✅ Ngrok tunnel ochildi")
@@ -1730,13 +2468,7 @@ if __name__ == "__main__":
     
     # Serverni ishga tushirish
     try:
-        app.run(
-            host="0.0.0.0",
-            port=8080,
-            debug=False,
-            threaded=True,
-            use_reloader=False
-        )
+        run_server()
     except KeyboardInterrupt:
         print("\nServerni to'xtatish...")
         stop_ngrok()